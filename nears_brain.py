@@ -1,9 +1,36 @@
 # near_core.py
 import os
 import asyncio
-from typing import Dict, List, Any
+import hashlib
+import random
+import time
+import re
+from collections import OrderedDict, deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Sequence
+import httpx
 from dotenv import load_dotenv
-from openai import OpenAI
+from openai import (
+    AsyncOpenAI,
+    APIConnectionError,
+    APITimeoutError,
+    InternalServerError,
+    RateLimitError,
+)
+
+try:
+    import numpy as np  # optional: only needed for the semantic reply cache
+except ImportError:
+    np = None
+
+try:
+    import tiktoken  # optional: exact token counts instead of a rough estimate
+except ImportError:
+    tiktoken = None
+
+try:
+    import xxhash  # optional: faster reply-cache keys than blake2b
+except ImportError:
+    xxhash = None
 
 # -----------------------------
 # Environment / OpenAI
@@ -14,44 +41,399 @@ OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 if OPENAI_API_KEY is None:
     raise RuntimeError("OPENAI_API_KEY is not set in .env")
 
-client_oai = OpenAI(api_key=OPENAI_API_KEY)
+# one shared async client so every call reuses the same keep-alive pool
+client_oai = AsyncOpenAI(
+    api_key=OPENAI_API_KEY,
+    max_retries=0,  # with_retries owns the retry policy
+    http_client=httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+    ),
+)
+
+# Caps in-flight OpenAI requests across all channels so bursts queue here
+# instead of turning into 429s.
+OPENAI_SEM = asyncio.Semaphore(int(os.getenv("OPENAI_CONCURRENCY", "32")))
+
+# Transient failures worth retrying; bad input / auth errors are not.
+RETRYABLE_ERRORS = (RateLimitError, APITimeoutError, APIConnectionError, InternalServerError)
+
+
+async def with_retries(
+    fn: Callable[[], Awaitable[Any]], max_attempts: int = 5, base: float = 0.5
+) -> Any:
+    """
+    Await ``fn()``, retrying RETRYABLE_ERRORS with exponential backoff and
+    jitter. The last failure is re-raised.
+    """
+    for attempt in range(max_attempts):
+        try:
+            return await fn()
+        except RETRYABLE_ERRORS:
+            if attempt == max_attempts - 1:
+                raise
+            await asyncio.sleep(min(60, base * 2**attempt + random.random() * 0.3))
+
+
+# Flagship model for normal chat; the smaller model is plenty for ELI5
+# explanations and riddles. (gpt-5.1 has no mini tier, so use gpt-5-mini.)
+MODEL_MAIN = "gpt-5.1"
+MODEL_CHEAP = "gpt-5-mini"
+
+# USD per 1M tokens: (input, cached input, output)
+MODEL_PRICES = {
+    MODEL_MAIN: (1.25, 0.125, 10.0),
+    MODEL_CHEAP: (0.25, 0.025, 2.0),
+}
+
+# Prompt caching: OpenAI caches request prefixes of 1024+ tokens. The persona
+# prompt always goes first and everything per-request follows it, and the
+# cache key keeps a channel's requests routed to the same cache.
+PROMPT_CACHE_VERSION = "near-v1"
+
+# -----------------------------
+# Token estimation
+# -----------------------------
+MAX_INPUT_TOKENS = 2000  # longer user messages are truncated before sending
+
+
+def _load_encoding() -> Any:
+    if tiktoken is None:
+        return None
+    try:
+        try:
+            return tiktoken.encoding_for_model(MODEL_MAIN)
+        except KeyError:
+            return tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        print(f"tiktoken unavailable, estimating tokens from length: {e}")
+        return None
+
+
+_encoding = _load_encoding()
+
+
+def estimate_tokens(text: str) -> int:
+    """Token count for ``text``; ~4 characters per token without tiktoken."""
+    if _encoding is None:
+        return len(text) // 4 + 1
+    return len(_encoding.encode(text, disallowed_special=()))
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Cut ``text`` down to roughly ``max_tokens`` tokens, marking the cut."""
+    if _encoding is None:
+        max_chars = max_tokens * 4
+        return text if len(text) <= max_chars else text[:max_chars] + " …"
+
+    tokens = _encoding.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    return _encoding.decode(tokens[:max_tokens]) + " …"
+
 
 # -----------------------------
 # Locks + history
 # -----------------------------
-locks_by_channel: Dict[int, asyncio.Lock] = {}
-history_by_channel: Dict[int, List[Dict[str, Any]]] = {}
+MAX_TRACKED_CHANNELS = 2048
+CHANNEL_IDLE_TTL = 3600  # seconds before a quiet channel's history is dropped
+CHANNEL_SWEEP_INTERVAL = 600  # seconds between sweeps for idle channels
+
+
+class LRUDict(OrderedDict):
+    """
+    Dict capped at ``capacity`` keys.
+
+    ``get`` and assignment mark a key as most recently used. Assigning past
+    capacity evicts the least recently used key and passes it to ``on_evict``.
+    With ``ttl`` set, keys unused for that many seconds are also evicted,
+    lazily, the next time the dict is read or written (or ``expire`` is
+    called). Keys for which ``can_evict`` returns False are skipped and stay
+    put.
+    """
+
+    def __init__(
+        self,
+        capacity: int,
+        on_evict: Callable[[Any], None] | None = None,
+        ttl: float | None = None,
+        can_evict: Callable[[Any], bool] | None = None,
+    ):
+        super().__init__()
+        self.capacity = capacity
+        self.on_evict = on_evict
+        self.ttl = ttl
+        self.can_evict = can_evict
+        self._touched: Dict[Any, float] = {}
+
+    def get(self, key, default=None):
+        self.expire()
+        if key not in self:
+            return default
+        self.move_to_end(key)
+        self._touched[key] = time.monotonic()
+        return self[key]
+
+    def __setitem__(self, key, value) -> None:
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        self._touched[key] = time.monotonic()
+        self.expire()
+        if len(self) > self.capacity:
+            # the oldest key that may go; pinned ones are stepped over
+            victim = next((k for k in self if k != key and self._evictable(k)), None)
+            if victim is not None:
+                self._evict(victim)
+
+    def get_or_create(self, key, factory: Callable[[], Any]):
+        """``get``, but store and return ``factory()`` if ``key`` is missing."""
+        value = self.get(key)
+        if value is None:
+            value = factory()
+            self[key] = value
+        return value
+
+    def pop(self, key, *default):
+        self._touched.pop(key, None)
+        return super().pop(key, *default)
+
+    def expire(self) -> None:
+        if self.ttl is None:
+            return
+        # keys are kept in last-used order, so the stale ones are a
+        # prefix, and the walk stops at the first fresh key
+        cutoff = time.monotonic() - self.ttl
+        stale = []
+        for old_key in self:
+            if self._touched.get(old_key, 0.0) > cutoff:
+                break
+            stale.append(old_key)
+        for old_key in stale:
+            self._evict(old_key)
+
+    def _evictable(self, key) -> bool:
+        return self.can_evict is None or self.can_evict(key)
+
+    def _evict(self, key) -> bool:
+        if key not in self or not self._evictable(key):
+            return False
+        self.pop(key)
+        if self.on_evict is not None:
+            self.on_evict(key)
+        return True
+
+
+# History entries are compact (role tag, content) tuples; they only become
+# {"role": ..., "content": ...} dicts when a request is built.
+HistoryEntry = tuple[str, str]
+HIST_ROLE = {"s": "system", "u": "user", "a": "assistant"}
+HISTORY_LEN = 40  # entries kept per channel
+
+# Start a fresh chain from the local history window after this many
+# chained replies, so the server-side conversation cannot grow forever.
+MAX_CHAIN_LENGTH = 20
+
+
+def as_messages(entries: Sequence[HistoryEntry]) -> list[dict]:
+    return [{"role": HIST_ROLE[tag], "content": content} for tag, content in entries]
+
+
+class ChannelState:
+    """Everything Near keeps about one channel; it is evicted as a whole."""
+
+    __slots__ = (
+        "lock",
+        "send_lock",
+        "send_bucket",
+        "history",
+        "pending",
+        "last_response",
+        "loaded",
+        "in_flight",
+    )
+
+    def __init__(self):
+        # guards history/pending/last_response while a request is built or
+        # committed; never held across the OpenAI call
+        self.lock = asyncio.Lock()
+        # held by a reply from its first message until it is finished, so
+        # two replies in one channel never interleave their messages
+        self.send_lock = asyncio.Lock()
+        # the Discord side's rate limiter for this channel, made on first send
+        self.send_bucket: Any = None
+        self.history: Deque[HistoryEntry] = deque(maxlen=HISTORY_LEN)
+        # entries recorded since Near's last reply. When the channel has a
+        # live response chain, only these are sent; the rest is on the server.
+        self.pending: Deque[HistoryEntry] = deque(maxlen=HISTORY_LEN)
+        # (response id, replies chained so far), or None without a chain
+        self.last_response: tuple[str, int] | None = None
+        # whether the history has been read back from Redis yet
+        self.loaded = redis_client is None
+        # get_near_reply calls working on this channel right now; no lock is
+        # held during the OpenAI call, so this is what pins a channel mid-reply
+        self.in_flight = 0
+
+
+def channel_is_idle(channel_id: int) -> bool:
+    """A channel with a reply in flight or a lock held must not be forgotten."""
+    # plain dict lookup: checking a channel should not count as using it
+    state = dict.get(channels, channel_id)
+    return state is None or not (
+        state.in_flight or state.lock.locked() or state.send_lock.locked()
+    )
+
+
+# One LRU over whole channel states, so a channel is forgotten by a single
+# recency order: the one that every message and reply refreshes.
+channels: LRUDict[int, ChannelState] = LRUDict(
+    MAX_TRACKED_CHANNELS, ttl=CHANNEL_IDLE_TTL, can_evict=channel_is_idle
+)
+
+
+def get_channel(channel_id: int) -> ChannelState:
+    return channels.get_or_create(channel_id, ChannelState)
 
 
 def get_channel_lock(channel_id: int) -> asyncio.Lock:
-    lock = locks_by_channel.get(channel_id)
-    if lock is None:
-        lock = asyncio.Lock()
-        locks_by_channel[channel_id] = lock
-    return lock
+    return get_channel(channel_id).lock
+
 
+def get_send_lock(channel_id: int) -> asyncio.Lock:
+    return get_channel(channel_id).send_lock
 
-def add_message_to_history(channel_id: int, user_name: str, text: str) -> None:
+
+async def add_message_to_history(channel_id: int, user_name: str, text: str) -> None:
     """
-    Record any message in the channel as contextual history.
+    Record a channel message that is not addressed to Near as contextual
+    history (messages to Near become user turns in get_near_reply).
 
     We store these as 'system' messages with a [Context] prefix so Near
     understands they are background conversation, not direct instructions.
     Near is allowed to ignore irrelevant context.
     """
-    history = history_by_channel.get(channel_id, [])
-    history.append(
-        {
-            "role": "system",
-            "content": f"[Context] {user_name} said: {text}",
-        }
-    )
+    await load_history(channel_id)
+    entry = ("s", f"[Context] {user_name} said: {text}")
+    _record(channel_id, entry)
+    _persist(channel_id, entry)
+
+
+async def add_reply_to_history(channel_id: int, text: str) -> None:
+    """
+    Record something Near said outside get_near_reply (e.g. a riddle) so
+    he can reference it later.
+    """
+    await load_history(channel_id)
+    entry = ("a", text)
+    _record(channel_id, entry)
+    _persist(channel_id, entry)
+
+
+def _record(channel_id: int, entry: HistoryEntry, pending: bool = True) -> None:
+    # bounded deques drop the oldest entry themselves once full
+    state = get_channel(channel_id)
+    state.history.append(entry)
+    if pending:
+        state.pending.append(entry)
+
+
+async def sweep_idle_channels() -> None:
+    """
+    Forget idle channels every CHANNEL_SWEEP_INTERVAL seconds.
+
+    Expiry is otherwise lazy, so without this a server that goes quiet keeps
+    its last channels' state around. Channels mid-reply are skipped by
+    channel_is_idle as usual. Runs until cancelled.
+    """
+    while True:
+        await asyncio.sleep(CHANNEL_SWEEP_INTERVAL)
+        channels.expire()
+
+
+# -----------------------------
+# Optional Redis persistence
+# -----------------------------
+# With REDIS_URL set, every history entry is also pushed onto a capped Redis
+# list, and a channel this process has no history for (after a restart, an
+# LRU eviction, or its shard moving to another process) is reloaded from it.
+# Discord delivers a guild's events to exactly one shard, so only one process
+# writes a given channel at a time and the asyncio channel locks still
+# serialize everything; Redis only has to make the history outlive us.
+REDIS_URL = os.getenv("REDIS_URL")
+HISTORY_TTL = 7 * 24 * 3600  # seconds an idle channel's history is kept
+
+if REDIS_URL:
+    import orjson
+    import redis.asyncio as aioredis
+
+    redis_client = aioredis.Redis.from_url(REDIS_URL)
+else:
+    redis_client = None
+
+
+def _history_key(channel_id: int) -> str:
+    return f"chan:{channel_id}:hist"
+
+
+async def load_history(channel_id: int) -> None:
+    """
+    Fill a channel's history from Redis the first time this process needs it.
+
+    Takes the channel lock, so callers must not already hold it.
+    """
+    state = get_channel(channel_id)
+    if state.loaded:
+        return
+
+    async with state.lock:
+        if state.loaded:
+            return
+        try:
+            raw = await redis_client.lrange(_history_key(channel_id), -HISTORY_LEN, -1)
+        except Exception as e:
+            print(f"Failed to load history for channel {channel_id}: {e}")
+            raw = []
+        state.history = deque(
+            (tuple(orjson.loads(item)) for item in raw), maxlen=HISTORY_LEN
+        )
+        state.loaded = True
+
+
+# Writes to Redis are coalesced: entries recorded within PERSIST_DELAY of
+# each other go out as one RPUSH + LTRIM instead of one round trip each.
+PERSIST_DELAY = 0.25
+_unpersisted: Dict[int, List[HistoryEntry]] = {}
+_flush_tasks: Dict[int, asyncio.Task] = {}
+
+
+def _persist(channel_id: int, entry: HistoryEntry) -> None:
+    """Queue a history entry for Redis; never blocks the caller."""
+    if redis_client is None:
+        return
+
+    _unpersisted.setdefault(channel_id, []).append(entry)
+    if channel_id not in _flush_tasks:
+        _flush_tasks[channel_id] = asyncio.create_task(_flush_history(channel_id))
 
-    # keep last 40 entries
-    if len(history) > 40:
-        history = history[-40:]
 
-    history_by_channel[channel_id] = history
+async def _flush_history(channel_id: int) -> None:
+    key = _history_key(channel_id)
+    try:
+        # keep going until nothing new arrived during the previous write,
+        # so one channel's batches are never written out of order
+        while channel_id in _unpersisted:
+            await asyncio.sleep(PERSIST_DELAY)
+            entries = _unpersisted.pop(channel_id)
+            try:
+                async with redis_client.pipeline(transaction=False) as pipe:
+                    pipe.rpush(key, *(orjson.dumps(e) for e in entries))
+                    pipe.ltrim(key, -HISTORY_LEN, -1)
+                    pipe.expire(key, HISTORY_TTL)
+                    await pipe.execute()
+            except Exception as e:
+                # losing persistence is not worth failing the reply over
+                print(f"Failed to persist history for channel {channel_id}: {e}")
+    finally:
+        _flush_tasks.pop(channel_id, None)
 
 
 # -----------------------------
@@ -75,164 +457,690 @@ NEAR_PROMPT = (
     "but you are free to ignore any context that seems irrelevant.\n\n"
 )
 
+# Shared, never-mutated message objects for the persona prompt and the
+# mode presets callers pass as ``extra_system``.
+_BASE_SYSTEM = ({"role": "system", "content": NEAR_PROMPT},)
+
+ELI5_EXTRA_SYSTEM = (
+    {
+        "role": "system",
+        "content": (
+            "For this reply only, explain the topic as if you were "
+            "speaking to a five-year-old child. "
+            "Use very simple words, short sentences, gentle tone, and "
+            "tiny analogies. Maintain Near's quiet, calm personality, "
+            "but simplify everything drastically."
+        ),
+    },
+)
+
 
 # -----------------------------
 # Message splitting (code-aware)
 # -----------------------------
-def split_into_messages(text: str, max_len: int = 1900) -> list[str]:
+# A line that opens or closes a code block: ``` after optional indentation.
+_FENCE_RE = re.compile(r"^[^\S\n]*```.*$", re.MULTILINE)
+
+
+def split_into_messages(text: str, max_len: int = 1990) -> list[str]:
     """
     Split a long reply into multiple Discord-safe messages, being careful
     with ``` code fences so each chunk has valid Markdown.
     """
+    # Fast path for the common case: a short reply with no code fences comes
+    # back as one message. Shorter than max_len means even the newline added
+    # after the last line fits, so the loop below would not split it either.
+    if len(text) < max_len and "```" not in text:
+        text = "\n".join(text.splitlines()).rstrip("\n")
+        return [text] if text.strip() else []
+
+    # Work on one string where every line, the last included, ends in "\n":
+    # a chunk is then a run of slices of it, and each line costs exactly
+    # len(line) + 1 characters, as in the final message.
+    text = "\n".join(text.splitlines()) + "\n"
+
+    # Cut the text into plain runs and single fence lines with one regex
+    # pass, so the loop below handles whole runs of lines at a time. Text
+    # without fences is a single run: the loop then only packs lines with
+    # one rfind per chunk and the fence handling never triggers.
+    segments: list[tuple[int, int, str | None]] = []
+    start = 0
+    if "```" in text:
+        for m in _FENCE_RE.finditer(text):
+            if m.start() > start:
+                segments.append((start, m.start(), None))
+            segments.append((m.start(), m.end() + 1, m.group().strip()))
+            start = m.end() + 1
+    if start < len(text):
+        segments.append((start, len(text), None))
+
     parts: list[str] = []
-    lines = text.splitlines()
-    current = ""
+    current: list[str] = []  # slices of the chunk being built, joined on flush
     current_len = 0
+    has_text = False  # current holds at least one non-blank line
+    ends_with_fence = False  # last non-blank line in current ends with ```
     in_code = False
     current_fence = ""  # e.g. ``` or ```python
 
-    for line in lines:
-        line_str = line + "\n"
-        stripped = line.strip()
-
-        # Detect fence line
-        is_fence = stripped.startswith("```")
-
-        # If adding this line would exceed max_len, flush current chunk
-        if current_len + len(line_str) > max_len and current:
-            if in_code:
-                # close code block before splitting
-                if not current.rstrip().endswith("```"):
-                    current += "```\n"
-                    current_len += 4
-            parts.append(current.rstrip("\n"))
-            current = ""
-            current_len = 0
-
-            # if we're still inside a code block, reopen in new chunk
-            if in_code and current_fence:
-                current += current_fence + "\n"
-                current_len = len(current)
-
-        # handle fence toggling AFTER possible split
-        if is_fence:
-            if not in_code:
-                in_code = True
-                current_fence = stripped  # remember full fence line
-            else:
-                in_code = False
-                current_fence = ""
-
-        current += line_str
-        current_len += len(line_str)
-
-    if current.strip():
-        if in_code and not current.rstrip().endswith("```"):
-            current += "```\n"
-        parts.append(current.rstrip("\n"))
+    for seg_start, seg_end, fence in segments:
+        pos = seg_start
+        while pos < seg_end:
+            # take as many whole lines as still fit in this chunk
+            end = text.rfind("\n", pos, min(pos + max_len - current_len, seg_end)) + 1
+            if end <= pos:
+                # not even the next line fits: flush current chunk
+                if current:
+                    if in_code and not ends_with_fence:
+                        # close code block before splitting
+                        current.append("```\n")
+                    parts.append("".join(current).rstrip("\n"))
+                    current = []
+                    current_len = 0
+                    has_text = False
+                    ends_with_fence = False
+
+                    # if we're still inside a code block, reopen in new chunk
+                    if in_code and current_fence:
+                        current.append(current_fence + "\n")
+                        current_len = len(current_fence) + 1
+                        has_text = True
+                        ends_with_fence = current_fence.endswith("```")
+
+                # that line goes in regardless, even if it is too long
+                end = text.index("\n", pos) + 1
+
+            # handle fence toggling AFTER possible split
+            if fence is not None:
+                if not in_code:
+                    in_code = True
+                    current_fence = fence  # remember full fence line
+                else:
+                    in_code = False
+                    current_fence = ""
+
+            piece = text[pos:end]
+            current.append(piece)
+            current_len += len(piece)
+            tail = piece.rstrip()
+            if tail:
+                has_text = True
+                ends_with_fence = tail.endswith("```")
+            pos = end
+
+    if has_text:
+        if in_code and not ends_with_fence:
+            current.append("```\n")
+        parts.append("".join(current).rstrip("\n"))
 
     return parts
 
 
+# -----------------------------
+# Streaming helper
+# -----------------------------
+STREAM_UPDATE_INTERVAL = 0.8  # seconds between partial-reply updates
+
+
+async def _stream_response(
+    on_update: Callable[[str], None] | None,
+    **request: Any,
+) -> tuple[str, Any]:
+    """
+    Stream a Responses API call and return (full_text, final_response).
+
+    Every STREAM_UPDATE_INTERVAL seconds the accumulated text is passed
+    to ``on_update``. It is called, not awaited: this runs inside an
+    OPENAI_SEM slot, so it may only hand the text off, never wait on Discord.
+    """
+    loop = asyncio.get_running_loop()
+    buffer: list[str] = []
+    last_update = loop.time()
+
+    async with client_oai.responses.stream(**request) as stream:
+        async for event in stream:
+            if event.type != "response.output_text.delta":
+                continue
+            buffer.append(event.delta)
+            now = loop.time()
+            if on_update is not None and now - last_update >= STREAM_UPDATE_INTERVAL:
+                last_update = now
+                on_update("".join(buffer))
+
+        # usage comes from the final response.completed event
+        response = await stream.get_final_response()
+
+    return response.output_text, response
+
+
 # -----------------------------
 # Riddle helper
 # -----------------------------
+# Riddles do not depend on the channel, so requests arriving within
+# RIDDLE_BATCH_WINDOW of each other are answered by one call asking for
+# several riddles at once, split on RIDDLE_SEPARATOR lines.
+RIDDLE_BATCH_WINDOW = 0.05  # seconds
+RIDDLE_BATCH_MAX = 5
+RIDDLE_SEPARATOR = "-----"
+_RIDDLE_SPLIT_RE = re.compile(rf"^[^\S\n]*{RIDDLE_SEPARATOR}[^\S\n]*$", re.MULTILINE)
+
+_RIDDLE_SYSTEM = {
+    "role": "system",
+    "content": (
+        "You are Near creating short, cryptic riddles about "
+        "computer science or mathematics or artificial intelligence. "
+        "You speak quietly, analytically, and with emotional detachment."
+    ),
+}
+_RIDDLE_FORMAT = (
+    "🧩 **Riddle:** <your riddle>\n\n"
+    "Then write:\n"
+    "||<short answer>||\n"
+    "No explanation unless asked.\n"
+    "Use a quiet, analytical Near-like tone with occasional subtle italics."
+)
+
+
+def _riddle_input(count: int) -> list[dict]:
+    if count == 1:
+        ask = (
+            "Create ONE short riddle about a computer science, machine learning, or "
+            "artificial intelligence concept.\n"
+            "Format it like this:\n"
+        )
+    else:
+        ask = (
+            f"Create {count} short riddles, each about a different computer science, "
+            "machine learning, or artificial intelligence concept.\n"
+            f"Put a line containing only {RIDDLE_SEPARATOR} between riddles.\n"
+            "Format each one like this:\n"
+        )
+    return [_RIDDLE_SYSTEM, {"role": "user", "content": ask + _RIDDLE_FORMAT}]
+
+
+async def _create_riddles(count: int) -> list[str]:
+    """One call for ``count`` riddles; may return fewer if the model strays."""
+
+    async def attempt():
+        async with OPENAI_SEM:
+            return await client_oai.responses.create(
+                model=MODEL_CHEAP,
+                input=_riddle_input(count),
+            )
+
+    resp = await with_retries(attempt)
+    if count == 1:
+        return [resp.output_text.strip()]
+    riddles = (r.strip() for r in _RIDDLE_SPLIT_RE.split(resp.output_text))
+    return [r for r in riddles if r][:count]
+
+
+_riddle_waiters: List[asyncio.Future] = []
+_riddle_batcher: asyncio.Task | None = None
+_riddle_calls: set[asyncio.Task] = set()  # strong refs until each call is done
+
+
+async def _answer_riddles(waiters: List[asyncio.Future]) -> None:
+    try:
+        riddles = await _create_riddles(len(waiters))
+        # top up one by one if the batched answer came back short
+        missing = len(waiters) - len(riddles)
+        if missing > 0:
+            singles = await asyncio.gather(
+                *(_create_riddles(1) for _ in range(missing))
+            )
+            riddles += [r[0] for r in singles]
+        results = riddles
+    except Exception as e:
+        results = [
+            f"Oops… I could not create a riddle this time. `{type(e).__name__}`"
+        ] * len(waiters)
+
+    for waiter, text in zip(waiters, results):
+        if not waiter.done():
+            waiter.set_result(text)
+
+
+async def _batch_riddles() -> None:
+    global _riddle_batcher
+    try:
+        while _riddle_waiters:
+            await asyncio.sleep(RIDDLE_BATCH_WINDOW)
+            while _riddle_waiters:
+                batch = _riddle_waiters[:RIDDLE_BATCH_MAX]
+                del _riddle_waiters[:RIDDLE_BATCH_MAX]
+                task = asyncio.create_task(_answer_riddles(batch))
+                _riddle_calls.add(task)
+                task.add_done_callback(_riddle_calls.discard)
+    finally:
+        _riddle_batcher = None
+
+
 async def generate_riddle_text() -> str:
     """
     Ask GPT to generate a single cryptic CS/ML/AI riddle with answer hidden
     in spoiler tags.
     """
+    global _riddle_batcher
+    waiter = asyncio.get_running_loop().create_future()
+    _riddle_waiters.append(waiter)
+    if _riddle_batcher is None:
+        _riddle_batcher = asyncio.create_task(_batch_riddles())
+    return await waiter
+
+
+# -----------------------------
+# Reply cache
+# -----------------------------
+# Exact tier: identical (prompt, system) pairs reuse the previous answer.
+# Keys are scoped to the asking user, the channel and the conversation (the
+# chain head plus the turns it has not seen). An answer is stored under the
+# conversation as it stands right after it was given, so only a repeat with
+# nothing said in between finds it; it is never served to another user, in
+# another channel or guild, or once the conversation has moved on.
+# Semantic tier (NEAR_SEMANTIC_CACHE=1, needs numpy): within that same scope,
+# prompts whose embeddings are nearly identical to a cached one reuse that
+# answer too. Nothing is embedded unless such a cached answer exists.
+# Either way an answer is only reused for REPLY_CACHE_TTL after it was made.
+REPLY_CACHE_SIZE = 512
+REPLY_CACHE_TTL = 600  # seconds
+SEMANTIC_CACHE = os.getenv("NEAR_SEMANTIC_CACHE") == "1" and np is not None
+SEMANTIC_THRESHOLD = 0.95
+EMBEDDING_MODEL = "text-embedding-3-small"
+CACHED_FOOTER = "\n\n_(cached reply — no API cost)_"
+
+# cache key -> (system hash, prompt, unit-length prompt embedding or None
+# until the semantic tier first needs it)
+_reply_embeddings: LRUDict[str, tuple[bytes, str, Any]] = LRUDict(REPLY_CACHE_SIZE)
+# cache key -> (reply text, time.monotonic() when it was stored)
+reply_cache: LRUDict[str, tuple[str, float]] = LRUDict(
+    REPLY_CACHE_SIZE, on_evict=lambda key: _reply_embeddings.pop(key, None)
+)
+
+
+def _digest(data: bytes) -> bytes:
+    # keys only live in this process, so which hash made them never matters
+    if xxhash is not None:
+        return xxhash.xxh3_128_digest(data)
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def conversation_digest(channel_id: int) -> bytes:
+    """Digest of what a request in this channel is built from, besides the prompt."""
+    state = get_channel(channel_id)
+    head = state.last_response[0] if state.last_response else ""
+    entries = state.pending if head else state.history
+    lines = [head, *(f"{role}:{text}" for role, text in entries)]
+    return _digest("\n".join(lines).encode())
+
+
+def reply_cache_key(
+    channel_id: int,
+    user_name: str,
+    user_text: str,
+    extra_system: Sequence[dict] | None,
+    model: str,
+) -> tuple[str, bytes]:
+    """
+    Return (cache key, system hash) for a user's prompt in a channel's
+    current conversation, with its extra system messages and model.
+
+    Near addresses people by name, so the asker is part of both: another
+    user never gets an answer written for someone else, by either tier.
+    """
+    system_text = "\n".join(
+        [str(channel_id), user_name, model, *(m["content"] for m in extra_system or [])]
+    )
+    system_hash = _digest(system_text.encode() + conversation_digest(channel_id))
+    key = _digest(f"{user_name}: {user_text}".encode() + system_hash).hex()
+    return key, system_hash
+
+
+def _fresh_reply(key: str) -> str | None:
+    entry = reply_cache.get(key)
+    if entry is None:
+        return None
+    reply_text, stored_at = entry
+    if time.monotonic() - stored_at > REPLY_CACHE_TTL:
+        reply_cache.pop(key)
+        _reply_embeddings.pop(key, None)
+        return None
+    return reply_text
+
+
+async def _embed(texts: list[str]) -> Any:
+    """Unit-length embeddings of ``texts``, one row each, or None on failure."""
+
+    async def attempt():
+        async with OPENAI_SEM:
+            return await client_oai.embeddings.create(model=EMBEDDING_MODEL, input=texts)
+
     try:
-        resp = client_oai.responses.create(
-            model="gpt-5.1",
-            input=[
-                {
-                    "role": "system",
-                    "content": (
-                        "You are Near creating short, cryptic riddles about "
-                        "computer science or mathematics or artificial intelligence. "
-                        "You speak quietly, analytically, and with emotional detachment."
-                    ),
-                },
-                {
-                    "role": "user",
-                    "content": (
-                        "Create ONE short riddle about a computer science, machine learning, or "
-                        "artificial intelligence concept.\n"
-                        "Format it like this:\n"
-                        "🧩 **Riddle:** <your riddle>\n\n"
-                        "Then write:\n"
-                        "||<short answer>||\n"
-                        "No explanation unless asked.\n"
-                        "Use a quiet, analytical Near-like tone with occasional subtle italics."
-                    ),
-                },
-            ],
-        )
-        return resp.output_text.strip()
-    except Exception as e:
-        return f"Oops… I could not create a riddle this time. `{type(e).__name__}`"
+        resp = await with_retries(attempt)
+    except Exception:
+        return None
+    vecs = np.asarray([d.embedding for d in resp.data], dtype=np.float32)
+    return vecs / np.linalg.norm(vecs, axis=1, keepdims=True)
+
+
+async def lookup_cached_reply(key: str, system_hash: bytes, user_text: str) -> str | None:
+    """
+    Return a cached reply for this prompt, or None.
+
+    The semantic tier only calls the embeddings API when an answer was
+    cached under the same system hash (same user, channel and conversation),
+    and embeds those cached prompts then, in the same call.
+    """
+    cached = _fresh_reply(key)
+    if cached is not None or not SEMANTIC_CACHE:
+        return cached
+
+    candidates = [
+        (k, prompt, vec)
+        for k, (h, prompt, vec) in _reply_embeddings.items()
+        if h == system_hash
+    ]
+    if not candidates:
+        return None
+
+    missing = [c for c in candidates if c[2] is None]
+    vecs = await _embed([user_text, *(prompt for _, prompt, _ in missing)])
+    if vecs is None:
+        return None
+    embedding, new_vecs = vecs[0], iter(vecs[1:])
+
+    keys, matrix = [], []
+    for k, prompt, vec in candidates:
+        if vec is None:
+            vec = next(new_vecs)
+            if k in _reply_embeddings:
+                _reply_embeddings[k] = (system_hash, prompt, vec)
+        keys.append(k)
+        matrix.append(vec)
+
+    scores = np.stack(matrix) @ embedding
+    best = int(scores.argmax())
+    if scores[best] >= SEMANTIC_THRESHOLD:
+        return _fresh_reply(keys[best])
+    return None
+
+
+def store_cached_reply(key: str, system_hash: bytes, user_text: str, reply_text: str) -> None:
+    reply_cache[key] = (reply_text, time.monotonic())
+    if SEMANTIC_CACHE:
+        _reply_embeddings[key] = (system_hash, user_text, None)
+
+
+# -----------------------------
+# Context selection
+# -----------------------------
+# Most [Context] lines have nothing to do with the question. Past a dozen of
+# them, only the best word-overlap matches and the latest few are sent.
+CONTEXT_TOP_K = 8
+CONTEXT_RECENT = 4
+_WORD_RE = re.compile(r"\w+")
+
+
+def _words(text: str) -> set[str]:
+    return set(_WORD_RE.findall(text.lower()))
+
+
+def select_context(entries: Sequence[HistoryEntry], user_text: str) -> list[HistoryEntry]:
+    """
+    Keep Near's own replies and the [Context] lines most relevant to
+    ``user_text``: the CONTEXT_TOP_K with the highest Jaccard word overlap
+    plus the CONTEXT_RECENT most recent. Chronological order is preserved.
+    """
+    context_idx = [i for i, (tag, _) in enumerate(entries) if tag == "s"]
+    if len(context_idx) <= CONTEXT_TOP_K + CONTEXT_RECENT:
+        return list(entries)
+
+    query = _words(user_text)
+    keep = set(context_idx[-CONTEXT_RECENT:])
+
+    scored = []
+    for i in context_idx[:-CONTEXT_RECENT]:
+        words = _words(entries[i][1])
+        union = len(query | words)
+        score = len(query & words) / union if union else 0.0
+        if score > 0:
+            scored.append((score, i))
+    scored.sort(reverse=True)
+    keep.update(i for _, i in scored[:CONTEXT_TOP_K])
+
+    return [e for i, e in enumerate(entries) if e[0] != "s" or i in keep]
+
+
+def split_context(entries: Sequence[HistoryEntry]) -> tuple[list[dict], list[dict]]:
+    """
+    Separate conversation turns from [Context] lines.
+
+    Returns (turns, context): the user/assistant turns as messages in order,
+    and the [Context] lines coalesced into at most one system message, which
+    goes near the end of the input so the turns before it stay a stable,
+    cacheable prefix.
+    """
+    turns = as_messages([e for e in entries if e[0] != "s"])
+    lines = [content for tag, content in entries if tag == "s"]
+    context = [{"role": "system", "content": "\n".join(lines)}] if lines else []
+    return turns, context
 
 
 # -----------------------------
 # Core Near call
 # -----------------------------
-async def get_near_reply(
+def prepare_request(
     channel_id: int,
     user_name: str,
     user_text: str,
-    extra_system: list[dict] | None = None,
-) -> str:
-    """
-    Core logic to talk to GPT-5.1 as Near and update history.
-    Uses stored context plus the current user message.
+    extra_system: Sequence[dict] | None = None,
+    model: str = MODEL_MAIN,
+) -> Dict[str, Any]:
     """
-    history = history_by_channel.get(channel_id, [])
-    if len(history) > 40:
-        history = history[-40:]
+    Build the Responses API request for one reply from the channel's state.
 
-    # base system message
-    system_messages = [{"role": "system", "content": NEAR_PROMPT}]
+    Replies are chained with ``previous_response_id``, so a channel with a
+    live chain only sends what happened since Near last spoke. Without one
+    (first reply, restart, error, or chain too long) the stored history
+    window is sent instead and a new chain starts.
+
+    Input is laid out most-stable first: Near's prompt, past turns, then
+    per-call extras (mode prompt, coalesced context, the new user turn).
+    """
+    state = get_channel(channel_id)
 
     # allow overrides from special commands like /eli5
-    if extra_system:
-        system_messages.extend(extra_system)
+    extra_system = extra_system or ()
 
     # current message as explicit user turn
-    user_turn = {"role": "user", "content": f"{user_name}: {user_text}"}
+    user_entry = ("u", f"{user_name}: {user_text}")
+
+    pending, state.pending = state.pending, deque(maxlen=HISTORY_LEN)
+    previous_id, chain_length = state.last_response or (None, 0)
+    if previous_id is not None and chain_length < MAX_CHAIN_LENGTH:
+        turns, context = split_context(select_context(pending, user_text))
+        request = {
+            "previous_response_id": previous_id,
+            "input": [*turns, *extra_system, *context, *as_messages([user_entry])],
+        }
+    else:
+        chain_length = 0
+        turns, context = split_context(select_context(state.history, user_text))
+        request = {
+            "input": [
+                *_BASE_SYSTEM,
+                *turns,
+                *extra_system,
+                *context,
+                *as_messages([user_entry]),
+            ]
+        }
+
+    request["model"] = model
+    request["prompt_cache_key"] = f"{PROMPT_CACHE_VERSION}:{channel_id}"
+    return {
+        "channel_id": channel_id,
+        # chain head when this request was built, used or not; commit_reply
+        # only advances the chain if nobody else has moved it since
+        "head": previous_id,
+        "chain_length": chain_length,
+        "pending": list(pending),
+        "user_entry": user_entry,
+        "request": request,
+    }
+
+
+async def call_openai(
+    payload: Dict[str, Any],
+    on_update: Callable[[str], None] | None = None,
+) -> tuple[str, Any]:
+    """
+    Run a prepared request and return (reply_text, response).
+
+    Transient failures are retried (a retried stream starts its partial
+    updates over); anything else comes back as a short error reply and
+    ``None``.
+    """
+
+    async def attempt():
+        async with OPENAI_SEM:
+            return await _stream_response(on_update, **payload["request"])
+
+    try:
+        return await with_retries(attempt)
+    except Exception as e:
+        return f"Oops, something went wrong talking to OpenAI: `{type(e).__name__}`", None
+
+
+def cost_footer(
+    response: Any, model: str, input_items: list[dict], reply_text: str
+) -> str:
+    """
+    Small italic footer estimating what a response cost. Uses the reported
+    usage, or local token estimates of what was sent and received if the
+    response has none.
+    """
+    usage = getattr(response, "usage", None)
+    if usage is not None:
+        input_tokens = getattr(usage, "input_tokens", 0)
+        output_tokens = getattr(usage, "output_tokens", 0)
+        details = getattr(usage, "input_tokens_details", None)
+        cached_tokens = getattr(details, "cached_tokens", 0) or 0
+    else:
+        input_tokens = sum(estimate_tokens(m["content"]) for m in input_items)
+        output_tokens = estimate_tokens(reply_text)
+        cached_tokens = 0
+
+    # Pricing per 1M tokens, see MODEL_PRICES
+    input_price, cached_price, output_price = MODEL_PRICES[model]
+    input_cost = (
+        (input_tokens - cached_tokens) * input_price + cached_tokens * cached_price
+    ) / 1_000_000
+    output_cost = (output_tokens / 1_000_000) * output_price
+    total_cost = input_cost + output_cost
+
+    cached_note = f" ({cached_tokens} cached)" if cached_tokens else ""
+    return (
+        f"\n\n_(approx cost this reply: "
+        f"${total_cost:.5f} — input {input_tokens} tok{cached_note}, "
+        f"output {output_tokens} tok)_"
+    )
+
+
+def commit_reply(payload: Dict[str, Any], reply_text: str, response_id: str | None) -> None:
+    """Store the exchange in history and advance the channel's response chain."""
+    channel_id = payload["channel_id"]
+    state = get_channel(channel_id)
+    exchange = (payload["user_entry"], ("a", reply_text))
+    for entry in exchange:
+        _record(channel_id, entry, pending=False)
+        _persist(channel_id, entry)
+
+    head = state.last_response[0] if state.last_response else None
+    if response_id is not None and head == payload["head"]:
+        state.last_response = (response_id, payload["chain_length"] + 1)
+        return
+
+    # The call failed, or another reply in this channel moved the chain on
+    # while this one was running: the server-side conversation is missing
+    # what this request sent, so it goes out again with the next one.
+    state.pending = deque(
+        [*payload["pending"], *exchange, *state.pending], maxlen=HISTORY_LEN
+    )
+
+
+async def get_near_reply(
+    channel_id: int,
+    user_name: str,
+    user_text: str,
+    extra_system: Sequence[dict] | None = None,
+    on_update: Callable[[str], None] | None = None,
+    model: str = MODEL_MAIN,
+) -> str:
+    """
+    Core logic to talk to GPT-5.1 (or ``model``) as Near and update history.
+
+    The channel lock is only held while reading and writing channel state;
+    the OpenAI round trip runs outside it, so other users in the same
+    channel are not stuck behind a slow reply.
+
+    If ``on_update`` is given, it is called with the partial reply text
+    while the response is still streaming, so callers can show it early.
+    It must return at once (e.g. store the text for a task that posts it).
+    """
+    user_text = truncate_to_tokens(user_text, MAX_INPUT_TOKENS)
 
+    # pin the channel until the reply is committed, so it is not swept or
+    # evicted while the OpenAI call runs
+    state = get_channel(channel_id)
+    state.in_flight += 1
     try:
-        response = client_oai.responses.create(
-            model="gpt-5.1",
-            input=system_messages + history + [user_turn],
+        await load_history(channel_id)
+        key, system_hash = reply_cache_key(
+            channel_id, user_name, user_text, extra_system, model
         )
-        reply_text = response.output_text
-
-        # --- cost calculation footer ---
-        usage = getattr(response, "usage", None)
-        if usage is not None:
-            input_tokens = getattr(usage, "input_tokens", 0)
-            output_tokens = getattr(usage, "output_tokens", 0)
-
-            # Pricing:
-            #  - input:  $1.25 per 1M tokens
-            #  - output: $10.00 per 1M tokens
-            input_cost = (input_tokens / 1_000_000) * 1.25
-            output_cost = (output_tokens / 1_000_000) * 10.0
-            total_cost = input_cost + output_cost
-
-            cost_footer = (
-                f"\n\n_(approx cost this reply: "
-                f"${total_cost:.5f} — input {input_tokens} tok, "
-                f"output {output_tokens} tok)_"
-            )
-            reply_text = reply_text + cost_footer
+        cached = await lookup_cached_reply(key, system_hash, user_text)
+        if cached is not None:
+            reply_text = cached + CACHED_FOOTER
+            # the response chain never saw this exchange, so it goes out as
+            # pending turns with the next request
+            for entry in (("u", f"{user_name}: {user_text}"), ("a", reply_text)):
+                _record(channel_id, entry)
+                _persist(channel_id, entry)
+            return reply_text
 
-    except Exception as e:
-        reply_text = f"Oops, something went wrong talking to OpenAI: `{type(e).__name__}`"
+        lock = get_channel_lock(channel_id)
+        async with lock:
+            payload = prepare_request(channel_id, user_name, user_text, extra_system, model)
 
-    # Save Near's reply as assistant message in history
-    history.append({"role": "assistant", "content": reply_text})
-    history_by_channel[channel_id] = history
+        answer, response = await call_openai(payload, on_update)
+        reply_text = answer
+        if response is not None:
+            reply_text += cost_footer(response, model, payload["request"]["input"], answer)
 
-    return reply_text
+        async with lock:
+            commit_reply(payload, reply_text, getattr(response, "id", None))
+            if response is not None:
+                key, system_hash = reply_cache_key(
+                    channel_id, user_name, user_text, extra_system, model
+                )
+                store_cached_reply(key, system_hash, user_text, answer)
+
+        return reply_text
+    finally:
+        state.in_flight -= 1
+
+
+# -----------------------------
+# Shutdown
+# -----------------------------
+async def close_brain() -> None:
+    """
+    Write out buffered history and close the OpenAI and Redis connections.
+
+    Call once when the bot shuts down; nothing here is usable afterwards.
+    """
+    if _flush_tasks:
+        await asyncio.gather(*_flush_tasks.values(), return_exceptions=True)
+    if redis_client is not None:
+        await redis_client.aclose()
+    await client_oai.close()
@@ -1,16 +1,26 @@
 # near_bot.py
 import os
+import re
+import json
+import asyncio
+import hashlib
+import time
 import discord
 from discord import app_commands
 from dotenv import load_dotenv
 
-import nears_brain
 from nears_brain import (
-    get_channel_lock,
     add_message_to_history,
+    close_brain,
+    sweep_idle_channels,
+    add_reply_to_history,
     split_into_messages,
     generate_riddle_text,
     get_near_reply,
+    get_channel,
+    get_send_lock,
+    ELI5_EXTRA_SYSTEM,
+    MODEL_CHEAP,
 )
 
 # -----------------------------
@@ -30,6 +40,236 @@ HELP_TEXT = (
     "• `/eli5 <topic>` — ELI5-style explanation via slash command."
 )
 
+# -----------------------------
+# Text command routing
+# -----------------------------
+CMD_HELP = "help"
+CMD_RIDDLE = "riddle"
+CMD_ELI5 = "eli5"
+
+# "n <subcommand> ..." or plain "n <message>"; group 1 is the subcommand
+# (None for plain chat), group 2 is the rest of the message.
+CMD_RE = re.compile(
+    rf"n(?:\s+({CMD_HELP}|{CMD_RIDDLE}|{CMD_ELI5})\b|\s)(.*)",
+    re.IGNORECASE | re.DOTALL,
+)
+
+
+# -----------------------------
+# Streaming replies (Discord-facing)
+# -----------------------------
+# Discord lets a channel take 5 messages per 5 seconds. Chunks of a reply
+# are sent one after another, so they always arrive in order, and every new
+# message is paced through a per-channel token bucket so bursts never run
+# into 429s.
+SEND_BURST = 5  # messages a quiet channel can send at once
+SEND_RATE = 1.0  # messages per second after that
+
+# Discord's hard limit is 2000 characters; leave room for a closing fence.
+MESSAGE_MAX_LEN = 1990
+
+
+class SendBucket:
+    """Token bucket for one channel's outgoing messages."""
+
+    def __init__(self):
+        self.tokens = float(SEND_BURST)
+        self.updated = time.monotonic()
+
+    async def acquire(self) -> None:
+        while True:
+            now = time.monotonic()
+            refill = (now - self.updated) * SEND_RATE
+            self.tokens = min(SEND_BURST, self.tokens + refill)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            # no lock needed: nothing awaits between the check and the take
+            await asyncio.sleep((1 - self.tokens) / SEND_RATE)
+
+
+async def wait_for_send_slot(channel_id: int) -> None:
+    # the bucket lives on the channel's state, so it is forgotten together
+    # with the rest of the channel and never comes back full on its own
+    state = get_channel(channel_id)
+    if state.send_bucket is None:
+        state.send_bucket = SendBucket()
+    await state.send_bucket.acquire()
+
+
+class StreamingReply:
+    """
+    Shows a reply in Discord while it is still being generated.
+
+    ``update`` only stores the newest text; a poster task shows it, so the
+    OpenAI stream never waits on Discord, and updates that pile up while a
+    post is in flight collapse into the latest one. Each shown update is
+    split with split_into_messages: a chunk that has filled up is posted as
+    its own message right away, and the last, still growing chunk is edited
+    in place. ``send_first`` posts the first message and ``send_more``
+    (default: ``send_first``) the rest; both must return the message.
+    ``finish`` brings the messages in line with the final text and posts
+    whatever is left one chunk at a time.
+
+    From its first message until ``finish``, a reply holds the channel's
+    send lock, so two replies in one channel never interleave their
+    messages. Use it as ``async with StreamingReply(...) as stream:`` so the
+    lock is released and the poster stopped even if the reply fails before
+    ``finish``.
+    """
+
+    def __init__(
+        self,
+        channel_id: int,
+        send_first,
+        send_more=None,
+        max_len: int = MESSAGE_MAX_LEN,
+    ):
+        self.channel_id = channel_id
+        self.send_first = send_first
+        self.send_more = send_more or send_first
+        self.max_len = max_len
+        self.messages = []  # posted Discord messages, one per chunk
+        self.posted: list[str] = []  # what each of them currently says
+        self.holding = False  # whether this reply holds the channel's send lock
+        self.latest = ""  # newest partial text handed over by update()
+        self.wake = asyncio.Event()
+        self.done = False
+        self.poster: asyncio.Task | None = None
+
+    async def __aenter__(self) -> "StreamingReply":
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        await self._stop_poster()
+        self.release()
+
+    async def _hold_send_lock(self) -> None:
+        if not self.holding:
+            await get_send_lock(self.channel_id).acquire()
+            self.holding = True
+
+    def release(self) -> None:
+        """Let the next reply in the channel post; safe to call twice."""
+        if self.holding:
+            self.holding = False
+            get_send_lock(self.channel_id).release()
+
+    async def _show(self, i: int, chunk: str) -> None:
+        """Make message ``i`` read ``chunk``, posting it if it is the next one."""
+        if i < len(self.messages):
+            if self.posted[i] != chunk:
+                await self.messages[i].edit(content=chunk)
+                self.posted[i] = chunk
+            return
+
+        send = self.send_first if i == 0 else self.send_more
+        await wait_for_send_slot(self.channel_id)
+        self.messages.append(await send(chunk))
+        self.posted.append(chunk)
+
+    def update(self, text: str) -> None:
+        """Hand over the reply so far; returns at once."""
+        self.latest = text
+        self.wake.set()
+        if self.poster is None:
+            self.poster = asyncio.create_task(self._post_updates())
+
+    async def _post_updates(self) -> None:
+        while True:
+            await self.wake.wait()
+            self.wake.clear()
+            if self.done:
+                return
+            await self._render(self.latest)
+
+    async def _stop_poster(self) -> None:
+        self.done = True
+        self.wake.set()
+        if self.poster is None:
+            return
+        if not self.holding:
+            # nothing posted yet, so nothing can be half-sent; this also
+            # stops it waiting for another reply's turn
+            self.poster.cancel()
+        # otherwise let a post in flight complete, so no message goes out
+        # unrecorded
+        await asyncio.gather(self.poster, return_exceptions=True)
+
+    async def _render(self, text: str) -> None:
+        try:
+            for i, chunk in enumerate(split_into_messages(text, self.max_len)):
+                if len(chunk) > self.max_len:
+                    # one unbroken line still being written
+                    chunk = chunk[: self.max_len - 2] + " …"
+                if i >= len(self.messages):
+                    # Near never talks over himself: another reply already
+                    # posting in this channel finishes first
+                    await self._hold_send_lock()
+                await self._show(i, chunk)
+        except discord.HTTPException:
+            # partial updates are best-effort; finish() posts the real text
+            pass
+
+    async def finish(self, text: str) -> None:
+        await self._stop_poster()
+        chunks = split_into_messages(text, self.max_len)
+        if not chunks:
+            self.release()
+            return
+
+        # only the posting is serialized per channel, the OpenAI call that
+        # produced ``text`` ran unlocked
+        await self._hold_send_lock()
+        try:
+            shown = len(self.messages)
+            for i, chunk in enumerate(chunks[: max(shown, 1)]):
+                try:
+                    await self._show(i, chunk)
+                except discord.HTTPException as e:
+                    # e.g. the preview was deleted, or the final chunk is
+                    # too long to edit in; post it anew rather than lose
+                    # the rest of the reply
+                    print(f"Failed to update reply chunk: {e}")
+                    await self._send_more_quietly(chunk)
+
+            # a retried stream can come back shorter than what was shown
+            for message in self.messages[len(chunks) :]:
+                try:
+                    await message.delete()
+                except discord.HTTPException as e:
+                    print(f"Failed to delete stale reply chunk: {e}")
+
+            rest = chunks[max(shown, 1) :]
+            for chunk in rest:
+                await self._send_more_quietly(chunk)
+        finally:
+            self.release()
+
+    async def _send_more_quietly(self, chunk: str) -> None:
+        # one failed chunk (e.g. a rate limit) must not stop the ones after it
+        try:
+            await wait_for_send_slot(self.channel_id)
+            await self.send_more(chunk)
+        except discord.HTTPException as e:
+            print(f"Failed to send reply chunk: {e}")
+
+
+async def keep_typing(channel) -> None:
+    """
+    Show the typing indicator in ``channel`` until cancelled.
+
+    Run as a task next to the reply, so its first request to Discord never
+    delays the OpenAI call and a failure to show it never fails the reply.
+    """
+    try:
+        async with channel.typing():
+            await asyncio.Event().wait()
+    except discord.HTTPException as e:
+        print(f"Failed to show typing indicator: {e}")
+
+
 # -----------------------------
 # Discord / env setup
 # -----------------------------
@@ -39,20 +279,76 @@ DISCORD_TOKEN = os.getenv("DISCORD_TOKEN")
 if DISCORD_TOKEN is None:
     raise RuntimeError("DISCORD_TOKEN is not set in .env")
 
+
+class NearClient(discord.Client):
+    sweeper: asyncio.Task | None = None
+
+    async def setup_hook(self) -> None:
+        # runs once per process, unlike on_ready which fires on every reconnect
+        self.sweeper = asyncio.create_task(sweep_idle_channels())
+
+    async def close(self) -> None:
+        if self.is_closed():
+            return
+        if self.sweeper is not None:
+            self.sweeper.cancel()
+        # disconnect from Discord first so no new replies start, then let
+        # the brain finish its writes and release its connections
+        await super().close()
+        await close_brain()
+
+
 intents = discord.Intents.default()
 intents.message_content = True
 intents.members = True
-bot = discord.Client(intents=intents)
+bot = NearClient(intents=intents)
 tree = app_commands.CommandTree(bot)
 
 
+# Signature of the last slash-command set pushed to Discord, so restarts and
+# reconnects skip tree.sync() when nothing changed.
+COMMAND_SIG_FILE = ".near_commands.sig"
+
+
+def command_signature() -> str:
+    commands = sorted(
+        (cmd.to_dict(tree) for cmd in tree.get_commands()),
+        key=lambda c: c["name"],
+    )
+    return hashlib.blake2b(
+        json.dumps(commands, sort_keys=True).encode(), digest_size=16
+    ).hexdigest()
+
+
+def read_synced_signature() -> str | None:
+    try:
+        with open(COMMAND_SIG_FILE, encoding="utf-8") as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def write_synced_signature(sig: str) -> None:
+    # write-then-rename so a crash mid-write never leaves a torn signature
+    tmp = COMMAND_SIG_FILE + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(sig)
+    os.replace(tmp, COMMAND_SIG_FILE)
+
+
 @bot.event
 async def on_ready():
     print(f"Logged in as {bot.user} (ID: {bot.user.id})")
     print("Ready to chat with GPT-5.1 as Near.")
 
+    sig = command_signature()
+    if sig == await asyncio.to_thread(read_synced_signature):
+        print("Slash commands unchanged; skipping sync.")
+        return
+
     try:
         await tree.sync()
+        await asyncio.to_thread(write_synced_signature, sig)
         print("Slash commands synced.")
     except Exception as e:
         print(f"Failed to sync commands: {e}")
@@ -77,23 +373,17 @@ async def near_cmd(interaction: discord.Interaction, prompt: str):
     channel_id = channel.id
     user_name = interaction.user.display_name
 
-    # add to history as context
-    add_message_to_history(channel_id, user_name, f"/near {prompt}")
-
     await interaction.response.defer(thinking=True)
 
-    lock = get_channel_lock(channel_id)
-    async with lock:
-        reply_text = await get_near_reply(channel_id, user_name, prompt)
+    async with StreamingReply(
+        channel_id,
+        lambda text: interaction.followup.send(text, wait=True),
+    ) as stream:
+        reply_text = await get_near_reply(
+            channel_id, user_name, prompt, on_update=stream.update
+        )
 
-    chunks = split_into_messages(reply_text)
-    first = True
-    for chunk in chunks:
-        if first:
-            await interaction.followup.send(chunk)
-            first = False
-        else:
-            await interaction.followup.send(chunk)
+        await stream.finish(reply_text)
 
 
 # -----------------------------
@@ -115,141 +405,125 @@ async def eli5_cmd(interaction: discord.Interaction, prompt: str):
     channel_id = channel.id
     user_name = interaction.user.display_name
 
-    add_message_to_history(channel_id, user_name, f"/eli5 {prompt}")
-
     await interaction.response.defer(thinking=True)
 
-    lock = get_channel_lock(channel_id)
-    async with lock:
-        extra_system = [
-            {
-                "role": "system",
-                "content": (
-                    "For this reply only, explain the topic as if you were "
-                    "speaking to a five-year-old child. "
-                    "Use very simple words, short sentences, gentle tone, and "
-                    "tiny analogies. Maintain Near's quiet, calm personality, "
-                    "but simplify everything drastically."
-                ),
-            }
-        ]
+    async with StreamingReply(
+        channel_id,
+        lambda text: interaction.followup.send(text, wait=True),
+    ) as stream:
         reply_text = await get_near_reply(
             channel_id,
             user_name,
             prompt,
-            extra_system=extra_system,
+            extra_system=ELI5_EXTRA_SYSTEM,
+            on_update=stream.update,
+            model=MODEL_CHEAP,
         )
 
-    chunks = split_into_messages(reply_text)
-    first = True
-    for chunk in chunks:
-        if first:
-            await interaction.followup.send(chunk)
-            first = False
-        else:
-            await interaction.followup.send(chunk)
+        await stream.finish(reply_text)
 
 
 # -----------------------------
 # Legacy text commands: n ...
 # -----------------------------
-@bot.event
-async def on_message(message: discord.Message):
-    if message.author.bot:
-        return
+# Each handler gets the message and the text after the subcommand.
+async def handle_help(message: discord.Message, payload: str) -> None:
+    await wait_for_send_slot(message.channel.id)
+    await message.reply(HELP_TEXT, mention_author=False)
 
-    content = message.content
-    lower = content.lower()
-    channel_id = message.channel.id
-    user_name = message.author.display_name
 
-    # record everything as context
-    add_message_to_history(channel_id, user_name, content)
+async def handle_riddle(message: discord.Message, payload: str) -> None:
+    riddle_text = await generate_riddle_text()
+    await wait_for_send_slot(message.channel.id)
+    await message.reply(riddle_text, mention_author=False)
 
-    # n help
-    if lower.startswith("n help"):
-        await message.reply(HELP_TEXT, mention_author=False)
-        return
+    # 🔹 add riddle to history so Near can reference it later
+    await add_reply_to_history(message.channel.id, riddle_text)
 
-    # n riddle
-    if lower.startswith("n riddle"):
-        riddle_text = await generate_riddle_text()
-        await message.reply(riddle_text, mention_author=False)
 
-        # 🔹 add riddle to history so Near can reference it later
-        history = nears_brain.history_by_channel.get(channel_id, [])
-        history.append({"role": "assistant", "content": riddle_text})
-        if len(history) > 40:
-            history = history[-40:]
-        nears_brain.history_by_channel[channel_id] = history
+async def handle_eli5(message: discord.Message, payload: str) -> None:
+    user_text = payload.strip(" ,:-\t\n")
 
+    if not user_text:
+        await wait_for_send_slot(message.channel.id)
+        await message.reply("What do you want me to explain simply? 🙂")
         return
 
-    # n eli5 ...
-    eli5_prefix = "n eli5"
-    if lower.startswith(eli5_prefix):
-        user_text = content[len(eli5_prefix):].strip(" ,:-").strip()
+    async with StreamingReply(
+        message.channel.id,
+        lambda text: message.reply(text, mention_author=False),
+        message.channel.send,
+    ) as stream:
+        typing = asyncio.create_task(keep_typing(message.channel))
+        try:
+            reply_text = await get_near_reply(
+                message.channel.id,
+                message.author.display_name,
+                user_text,
+                extra_system=ELI5_EXTRA_SYSTEM,
+                on_update=stream.update,
+                model=MODEL_CHEAP,
+            )
+        finally:
+            typing.cancel()
+
+        await stream.finish(reply_text)
+
+
+async def handle_chat(message: discord.Message, payload: str) -> None:
+    # plain n ...
+    user_text = payload.strip()
+    if not user_text:
+        await wait_for_send_slot(message.channel.id)
+        await message.reply("What do you want to ask? 🙂")
+        return
 
-        if not user_text:
-            await message.reply("What do you want me to explain simply? 🙂")
-            return
+    async with StreamingReply(
+        message.channel.id,
+        lambda text: message.reply(text, mention_author=False),
+        message.channel.send,
+    ) as stream:
+        typing = asyncio.create_task(keep_typing(message.channel))
+        try:
+            reply_text = await get_near_reply(
+                message.channel.id,
+                message.author.display_name,
+                user_text,
+                on_update=stream.update,
+            )
+        finally:
+            typing.cancel()
+
+        await stream.finish(reply_text)
+
+
+# subcommand (lowercased CMD_RE group 1) -> handler; anything else is chat
+COMMAND_HANDLERS = {
+    CMD_HELP: handle_help,
+    CMD_RIDDLE: handle_riddle,
+    CMD_ELI5: handle_eli5,
+}
 
-        extra_system = [
-            {
-                "role": "system",
-                "content": (
-                    "For this reply only, explain the topic as if you were "
-                    "speaking to a five-year-old child. "
-                    "Use very simple words, short sentences, gentle tone, and "
-                    "tiny analogies. Maintain Near's quiet, calm personality, "
-                    "but simplify everything drastically."
-                ),
-            }
-        ]
-
-        lock = get_channel_lock(channel_id)
-        async with lock:
-            async with message.channel.typing():
-                reply_text = await get_near_reply(
-                    channel_id,
-                    user_name,
-                    user_text,
-                    extra_system=extra_system,
-                )
-
-        chunks = split_into_messages(reply_text)
-        first = True
-        for chunk in chunks:
-            if first:
-                await message.reply(chunk, mention_author=False)
-                first = False
-            else:
-                await message.channel.send(chunk)
-        return
 
-    # plain n ...
-    prefix = "n "
-    if not lower.startswith(prefix):
+@bot.event
+async def on_message(message: discord.Message):
+    if message.author.bot:
         return
 
-    user_text = content[len(prefix):].strip()
-    if not user_text:
-        await message.reply("What do you want to ask? 🙂")
+    # most messages are plain chatter: skip the regex unless one could match
+    content = message.content
+    m = CMD_RE.match(content) if content[:1] in ("n", "N") else None
+    if m is None:
+        # record everything else as context; commands to Near are stored
+        # as explicit user turns by get_near_reply instead
+        await add_message_to_history(
+            message.channel.id, message.author.display_name, content
+        )
         return
 
-    lock = get_channel_lock(channel_id)
-    async with lock:
-        async with message.channel.typing():
-            reply_text = await get_near_reply(channel_id, user_name, user_text)
-
-    chunks = split_into_messages(reply_text)
-    first = True
-    for chunk in chunks:
-        if first:
-            await message.reply(chunk, mention_author=False)
-            first = False
-        else:
-            await message.channel.send(chunk)
+    command = (m.group(1) or "").lower()
+    handler = COMMAND_HANDLERS.get(command, handle_chat)
+    await handler(message, m.group(2))
 
 
 # -----------------------------
@@ -0,0 +1,111 @@
+"""
+split_into_messages must chunk exactly like the original line-by-line
+splitter it replaced; only its speed was meant to change.
+
+Run with: python -m unittest discover tests
+"""
+
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("OPENAI_API_KEY", "test")  # nears_brain refuses to import without one
+
+from nears_brain import split_into_messages
+
+
+def original_split_into_messages(text: str, max_len: int = 1900) -> list[str]:
+    """The splitter as first written, kept verbatim as the reference."""
+    parts: list[str] = []
+    lines = text.splitlines()
+    current = ""
+    current_len = 0
+    in_code = False
+    current_fence = ""  # e.g. ``` or ```python
+
+    for line in lines:
+        line_str = line + "\n"
+        stripped = line.strip()
+
+        # Detect fence line
+        is_fence = stripped.startswith("```")
+
+        # If adding this line would exceed max_len, flush current chunk
+        if current_len + len(line_str) > max_len and current:
+            if in_code:
+                # close code block before splitting
+                if not current.rstrip().endswith("```"):
+                    current += "```\n"
+                    current_len += 4
+            parts.append(current.rstrip("\n"))
+            current = ""
+            current_len = 0
+
+            # if we're still inside a code block, reopen in new chunk
+            if in_code and current_fence:
+                current += current_fence + "\n"
+                current_len = len(current)
+
+        # handle fence toggling AFTER possible split
+        if is_fence:
+            if not in_code:
+                in_code = True
+                current_fence = stripped  # remember full fence line
+            else:
+                in_code = False
+                current_fence = ""
+
+        current += line_str
+        current_len += len(line_str)
+
+    if current.strip():
+        if in_code and not current.rstrip().endswith("```"):
+            current += "```\n"
+        parts.append(current.rstrip("\n"))
+
+    return parts
+
+
+# Fence lines, near-fences, blank and whitespace-only lines, long lines and
+# the odd line breaks str.splitlines() also splits on.
+PIECES = [
+    "```", "```python", "``` ", "  ```js", "\xa0```py", "\x1f```",
+    "foo```", "a ``` b", "hello world", "word " * 30,
+    "x" * 50, "y" * 700, "z" * 1995, "", "   ", "\t",
+    "a\r\nb", "c\rd", "\x0b", "e\u2028f",
+]
+MAX_LENS = [3, 8, 60, 1990]
+
+
+def random_text(rng: random.Random) -> str:
+    count = rng.choice([rng.randint(0, 4), rng.randint(0, 40)])
+    newline = rng.choice(["\n", "\r\n", "\n\n"])
+    text = newline.join(rng.choice(PIECES) for _ in range(count))
+    return text + "\n" if rng.random() < 0.2 else text
+
+
+class SplitIntoMessagesTest(unittest.TestCase):
+    def test_matches_original_splitter(self):
+        rng = random.Random(0)
+        for _ in range(5000):
+            text = random_text(rng)
+            max_len = rng.choice(MAX_LENS)
+            with self.subTest(text=text[:80], max_len=max_len):
+                self.assertEqual(
+                    split_into_messages(text, max_len),
+                    original_split_into_messages(text, max_len),
+                )
+
+    def test_long_reply_without_fences(self):
+        text = "\n".join(f"line {i} " + "w" * (i % 90) for i in range(2000))
+        for max_len in MAX_LENS:
+            self.assertEqual(
+                split_into_messages(text, max_len),
+                original_split_into_messages(text, max_len),
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()